@@ -1,13 +1,53 @@
+import asyncio
+import binascii
+import hashlib
 import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
 from typing import List, Optional, Any, Dict
-from fastapi import FastAPI, HTTPException, Query
+import msgspec
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from bson import ObjectId
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic_core import core_schema
+from bson import ObjectId, decode_all
+from pymongo import IndexModel
 
 from database import db, create_document, get_documents
 
-app = FastAPI(title="Car Rental API", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Indexes follow the ESR rule (equality fields first, then the sort
+    # field) so filtered + sorted car queries avoid COLLSCAN and in-memory
+    # sorts. create_indexes is a no-op for indexes that already exist.
+    if db is not None:
+        await db["car"].create_indexes(
+            [
+                IndexModel([("type", 1), ("price_per_day", 1)]),
+                IndexModel([("brand", 1), ("price_per_day", 1)]),
+                IndexModel([("popularity", -1)]),
+                IndexModel([("created_at", -1)]),
+                IndexModel([("available", 1), ("price_per_day", 1)]),
+            ]
+        )
+        await db["booking"].create_index([("user_id", 1), ("created_at", -1)])
+    yield
+
+
+# orjson encodes responses in C; the big wins are the images/features
+# lists on car documents and datetimes, which it handles natively.
+app = FastAPI(
+    title="Car Rental API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,41 +59,230 @@ app.add_middleware(
 
 
 # Utilities
+@lru_cache(maxsize=4096)
+def _parse_oid(s: str) -> ObjectId:
+    # The same ids recur constantly within a browse session; cache the
+    # hex parse + validity check instead of redoing it per request.
+    return ObjectId(s)
+
+
 class PyObjectId(ObjectId):
     @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
+    def __get_pydantic_core_schema__(cls, source_type, handler):
+        # The legacy __get_validators__ hook routes through pydantic's v1
+        # compatibility shim; a core schema dispatches straight from Rust.
+        return core_schema.no_info_plain_validator_function(
+            cls.validate, serialization=core_schema.to_string_ser_schema()
+        )
 
     @classmethod
     def validate(cls, v):
         if not ObjectId.is_valid(v):
             raise ValueError("Invalid objectid")
-        return ObjectId(v)
+        return _parse_oid(str(v))
 
 
 def serialize_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
     if not doc:
         return doc
+    # _id is the only ObjectId field in our collections (user_id/car_id are
+    # stored as strings), so skip the per-field isinstance sweep. The sweep
+    # stays as a debug-only safety net for schema drift.
     doc["id"] = str(doc.pop("_id"))
-    for k, v in list(doc.items()):
-        if isinstance(v, ObjectId):
-            doc[k] = str(v)
+    if __debug__:
+        for k, v in list(doc.items()):
+            if isinstance(v, ObjectId):
+                doc[k] = str(v)
     return doc
 
 
-# Schemas for requests
-class CarFilters(BaseModel):
-    type: Optional[str] = None
-    brand: Optional[str] = None
-    transmission: Optional[str] = None
-    fuel_type: Optional[str] = None
-    seats_gte: Optional[int] = None
-    min_price: Optional[float] = None
-    max_price: Optional[float] = None
-    sort: Optional[str] = Field(None, description="price_asc|price_desc|popularity|newest")
+def serialize_batch(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # Batch variant of serialize_doc: hex-encode all _ids with one C-level
+    # b2a_hex call over the concatenated 12-byte blobs instead of one
+    # str(ObjectId) per document.
+    blob = b"".join(doc["_id"].binary for doc in docs)
+    hexed = binascii.b2a_hex(blob).decode()
+    for i, doc in enumerate(docs):
+        del doc["_id"]
+        doc["id"] = hexed[i * 24:(i + 1) * 24]
+    return docs
+
+
+# Card-level fields only: the list view never shows description/features,
+# so don't decode or ship them. $slice keeps just the cover image.
+CAR_LIST_PROJECTION = {
+    "brand": 1,
+    "model": 1,
+    "type": 1,
+    "transmission": 1,
+    "fuel_type": 1,
+    "seats": 1,
+    "price_per_day": 1,
+    "popularity": 1,
+    "images": {"$slice": 1},
+    "available": 1,
+}
+
+
+# Hoisted so the handler neither rebuilds the dict per request nor chains
+# .sort() post-hoc; passing sort= into find() encodes one command.
+_SORT_MAP = {
+    "price_asc": [("price_per_day", 1)],
+    "price_desc": [("price_per_day", -1)],
+    "popularity": [("popularity", -1)],
+    "newest": [("created_at", -1)],
+}
+
+_BOOKINGS_SORT = [("created_at", -1)]
+
+
+# Mocked data so the frontend still previews nicely without a database.
+_DEMO_CARS = [
+    {
+        "id": "demo-1",
+        "brand": "Tesla",
+        "model": "Model 3",
+        "type": "sedan",
+        "transmission": "automatic",
+        "fuel_type": "electric",
+        "seats": 5,
+        "luggage": 3,
+        "mileage": 12000,
+        "price_per_day": 89,
+        "popularity": 98,
+        "images": [
+            "https://images.unsplash.com/photo-1511390420183-3a2c5a36f3f1?q=80&w=1200&auto=format&fit=crop"
+        ],
+        "features": ["Autopilot", "Bluetooth", "A/C"],
+        "available": True,
+        "description": "Sleek EV with long range and premium comfort.",
+    },
+    {
+        "id": "demo-2",
+        "brand": "BMW",
+        "model": "X5",
+        "type": "suv",
+        "transmission": "automatic",
+        "fuel_type": "hybrid",
+        "seats": 5,
+        "luggage": 4,
+        "mileage": 24000,
+        "price_per_day": 129,
+        "popularity": 92,
+        "images": [
+            "https://images.unsplash.com/photo-1619767886558-efdc259cde1c?q=80&w=1200&auto=format&fit=crop"
+        ],
+        "features": ["Panoramic Roof", "Leather", "GPS"],
+        "available": True,
+        "description": "Luxury SUV perfect for family trips.",
+    },
+]
+
+
+# Demo detail payload for get_car; the requested id is patched in per call.
+_DEMO_CAR_DETAIL = {
+    "brand": "Tesla",
+    "model": "Model 3 Performance",
+    "type": "sedan",
+    "transmission": "automatic",
+    "fuel_type": "electric",
+    "seats": 5,
+    "luggage": 3,
+    "mileage": 12000,
+    "price_per_day": 99,
+    "popularity": 99,
+    "images": [
+        "https://images.unsplash.com/photo-1511390420183-3a2c5a36f3f1?q=80&w=1200&auto=format&fit=crop",
+        "https://images.unsplash.com/photo-1549921296-3c2b3f6b33b5?q=80&w=1200&auto=format&fit=crop",
+    ],
+    "features": ["Autopilot", "Heated Seats", "Premium Audio"],
+    "available": True,
+    "description": "Performance EV with thrilling acceleration.",
+    "reviews": [
+        {"user": "Alex", "rating": 5, "comment": "Amazing ride!"},
+        {"user": "Sam", "rating": 4, "comment": "Very comfortable."},
+    ],
+}
+
+
+_DEMO_BOOKINGS = [
+    {
+        "id": "demo-book-1",
+        "user_id": "u1",
+        "car_id": "demo-1",
+        "pickup_location": "Downtown",
+        "dropoff_location": "Airport",
+        "start_date": "2025-12-01",
+        "end_date": "2025-12-05",
+        "total_price": 356,
+        "status": "confirmed",
+        "payment_status": "paid",
+    }
+]
+
+
+# Pre-encoded no-db responses: the demo payloads are constant, so the
+# handlers can hand the bytes straight to the socket.
+_DEMO_CARS_JSON = orjson.dumps({"items": _DEMO_CARS, "count": len(_DEMO_CARS)})
+_DEMO_BOOKINGS_JSON = orjson.dumps({"items": _DEMO_BOOKINGS, "count": len(_DEMO_BOOKINGS)})
+
+
+# Car inventory changes rarely, so identical filter combinations can be
+# answered from memory for a short window. Safe to keep in-process: the
+# endpoint is public, unauthenticated inventory with no per-user data.
+_cars_cache: TTLCache = TTLCache(maxsize=512, ttl=30)
+_cars_cache_lock = threading.Lock()
+
+
+def _invalidate_cars_cache() -> None:
+    with _cars_cache_lock:
+        _cars_cache.clear()
+
+
+# Coalesces concurrent cache misses for the same filter tuple: the first
+# request runs the query, the rest await its Future. Single event loop, so
+# no lock is needed around the dict itself.
+_cars_inflight: Dict[tuple, asyncio.Future] = {}
+
+
+def _weak_etag(body: bytes) -> str:
+    digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+    return f'W/"{digest}"'
+
+
+def _cached_cars_response(request: Request, body: bytes, etag: str) -> Response:
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+# /test is hit by uptime probes; resolve the env flags once at import time
+# and refresh the listCollections result at most once a minute.
+_DATABASE_URL_SET = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
+_DATABASE_NAME_SET = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+
+_COLLECTIONS_TTL = 60.0
+_collections_cache: tuple = (0.0, None)
+
+
+async def _cached_collection_names():
+    global _collections_cache
+    stamp, names = _collections_cache
+    if names is None or time.monotonic() - stamp > _COLLECTIONS_TTL:
+        names = await db.list_collection_names()
+        _collections_cache = (time.monotonic(), names)
+    return names
+
+
+def _invalidate_collections_cache() -> None:
+    global _collections_cache
+    _collections_cache = (0.0, None)
 
 
-class BookingRequest(BaseModel):
+# Schemas for requests. The booking payload is flat strings/floats, so a
+# msgspec Struct validates it in C; the decoder instance is reused across
+# requests. (CarFilters was unused — list_cars takes Query params directly.)
+class BookingRequest(msgspec.Struct):
     user_id: str
     car_id: str
     pickup_location: str
@@ -64,13 +293,17 @@ class BookingRequest(BaseModel):
     notes: Optional[str] = None
 
 
+_booking_decoder = msgspec.json.Decoder(BookingRequest)
+
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Car Rental Backend Running"}
 
 
 @app.get("/api/cars")
-def list_cars(
+async def list_cars(
+    request: Request,
     type: Optional[str] = None,
     brand: Optional[str] = None,
     transmission: Optional[str] = None,
@@ -82,179 +315,172 @@ def list_cars(
     limit: int = Query(50, ge=1, le=200),
 ):
     if db is None:
-        # Return mocked data so frontend still previews nicely
-        demo = [
-            {
-                "id": "demo-1",
-                "brand": "Tesla",
-                "model": "Model 3",
-                "type": "sedan",
-                "transmission": "automatic",
-                "fuel_type": "electric",
-                "seats": 5,
-                "luggage": 3,
-                "mileage": 12000,
-                "price_per_day": 89,
-                "popularity": 98,
-                "images": [
-                    "https://images.unsplash.com/photo-1511390420183-3a2c5a36f3f1?q=80&w=1200&auto=format&fit=crop"
-                ],
-                "features": ["Autopilot", "Bluetooth", "A/C"],
-                "available": True,
-                "description": "Sleek EV with long range and premium comfort.",
-            },
-            {
-                "id": "demo-2",
-                "brand": "BMW",
-                "model": "X5",
-                "type": "suv",
-                "transmission": "automatic",
-                "fuel_type": "hybrid",
-                "seats": 5,
-                "luggage": 4,
-                "mileage": 24000,
-                "price_per_day": 129,
-                "popularity": 92,
-                "images": [
-                    "https://images.unsplash.com/photo-1619767886558-efdc259cde1c?q=80&w=1200&auto=format&fit=crop"
-                ],
-                "features": ["Panoramic Roof", "Leather", "GPS"],
-                "available": True,
-                "description": "Luxury SUV perfect for family trips.",
-            },
-        ]
-        return {"items": demo[:limit], "count": len(demo[:limit])}
-
-    query: Dict[str, Any] = {}
-    if type:
-        query["type"] = type
-    if brand:
-        query["brand"] = brand
-    if transmission:
-        query["transmission"] = transmission
-    if fuel_type:
-        query["fuel_type"] = fuel_type
-    if seats_gte is not None:
-        query["seats"] = {"$gte": seats_gte}
-    if min_price is not None or max_price is not None:
-        price_q: Dict[str, Any] = {}
-        if min_price is not None:
-            price_q["$gte"] = min_price
-        if max_price is not None:
-            price_q["$lte"] = max_price
-        query["price_per_day"] = price_q
-
-    sort_map = {
-        "price_asc": ("price_per_day", 1),
-        "price_desc": ("price_per_day", -1),
-        "popularity": ("popularity", -1),
-        "newest": ("created_at", -1),
-    }
-
-    cursor = db["car"].find(query)
-    if sort and sort in sort_map:
-        field, direction = sort_map[sort]
-        cursor = cursor.sort(field, direction)
-    cursor = cursor.limit(limit)
+        if limit >= len(_DEMO_CARS):
+            return Response(content=_DEMO_CARS_JSON, media_type="application/json")
+        demo = _DEMO_CARS[:limit]
+        return {"items": demo, "count": len(demo)}
+
+    cache_key = (
+        type, brand, transmission, fuel_type, seats_gte, min_price, max_price, sort, limit,
+    )
+    with _cars_cache_lock:
+        cached = _cars_cache.get(cache_key)
+    if cached is not None:
+        body, etag = cached
+        return _cached_cars_response(request, body, etag)
+
+    inflight = _cars_inflight.get(cache_key)
+    if inflight is not None:
+        body, etag = await inflight
+        return _cached_cars_response(request, body, etag)
+    future: asyncio.Future = asyncio.get_running_loop().create_future()
+    _cars_inflight[cache_key] = future
 
-    items = [serialize_doc(doc) for doc in cursor]
-    return {"items": items, "count": len(items)}
+    try:
+        query: Dict[str, Any] = {}
+        if type:
+            query["type"] = type
+        if brand:
+            query["brand"] = brand
+        if transmission:
+            query["transmission"] = transmission
+        if fuel_type:
+            query["fuel_type"] = fuel_type
+        if seats_gte is not None:
+            query["seats"] = {"$gte": seats_gte}
+        if min_price is not None or max_price is not None:
+            price_q: Dict[str, Any] = {}
+            if min_price is not None:
+                price_q["$gte"] = min_price
+            if max_price is not None:
+                price_q["$lte"] = max_price
+            query["price_per_day"] = price_q
+
+        # Raw batches let bson decode each server batch in a single C call
+        # instead of materializing documents one by one.
+        # batch_size >= limit keeps small pages inside the firstBatch of the
+        # find reply, avoiding a getMore round trip (server caps at 101).
+        cursor = db["car"].find_raw_batches(
+            query,
+            projection=CAR_LIST_PROJECTION,
+            sort=_SORT_MAP.get(sort),
+            limit=limit,
+            batch_size=min(limit, 101),
+        )
+
+        items = []
+        async for raw_batch in cursor:
+            items.extend(serialize_batch(decode_all(raw_batch)))
+        # Encode to JSON bytes once; cache hits then forward the bytes straight
+        # to the socket with no dict hop or re-encode.
+        body = orjson.dumps({"items": items, "count": len(items)})
+        etag = _weak_etag(body)
+        with _cars_cache_lock:
+            _cars_cache[cache_key] = (body, etag)
+        future.set_result((body, etag))
+    except Exception as exc:
+        future.set_exception(exc)
+        # Waiters re-raise via the future; mark it retrieved for the case
+        # where nobody else was waiting.
+        future.exception()
+        raise
+    finally:
+        _cars_inflight.pop(cache_key, None)
+
+    return _cached_cars_response(request, body, etag)
 
 
 @app.get("/api/cars/{car_id}")
-def get_car(car_id: str):
+async def get_car(car_id: str):
     if db is None:
         # return a demo car
-        return {
-            "id": car_id,
-            "brand": "Tesla",
-            "model": "Model 3 Performance",
-            "type": "sedan",
-            "transmission": "automatic",
-            "fuel_type": "electric",
-            "seats": 5,
-            "luggage": 3,
-            "mileage": 12000,
-            "price_per_day": 99,
-            "popularity": 99,
-            "images": [
-                "https://images.unsplash.com/photo-1511390420183-3a2c5a36f3f1?q=80&w=1200&auto=format&fit=crop",
-                "https://images.unsplash.com/photo-1549921296-3c2b3f6b33b5?q=80&w=1200&auto=format&fit=crop",
-            ],
-            "features": ["Autopilot", "Heated Seats", "Premium Audio"],
-            "available": True,
-            "description": "Performance EV with thrilling acceleration.",
-            "reviews": [
-                {"user": "Alex", "rating": 5, "comment": "Amazing ride!"},
-                {"user": "Sam", "rating": 4, "comment": "Very comfortable."},
-            ],
-        }
+        return {"id": car_id, **_DEMO_CAR_DETAIL}
 
     try:
-        oid = ObjectId(car_id)
+        oid = _parse_oid(car_id)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid car id")
 
-    doc = db["car"].find_one({"_id": oid})
+    doc = await db["car"].find_one({"_id": oid})
     if not doc:
         raise HTTPException(status_code=404, detail="Car not found")
     return serialize_doc(doc)
 
 
 @app.post("/api/bookings")
-def create_booking(payload: BookingRequest):
+async def create_booking(request: Request):
+    try:
+        payload = _booking_decoder.decode(await request.body())
+    except (msgspec.ValidationError, msgspec.DecodeError) as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
     if db is None:
         # Mock booking id
-        return {"id": "demo-booking-123", "status": "pending", **payload.model_dump()}
+        return {"id": "demo-booking-123", "status": "pending", **msgspec.to_builtins(payload)}
 
     # Validate car exists
     try:
-        car_oid = ObjectId(payload.car_id)
+        car_oid = _parse_oid(payload.car_id)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid car id")
 
-    car = db["car"].find_one({"_id": car_oid})
-    if not car:
-        raise HTTPException(status_code=404, detail="Car not found")
-
-    data = payload.model_dump()
-    inserted_id = create_document("booking", data)
-    doc = db["booking"].find_one({"_id": ObjectId(inserted_id)})
-    return serialize_doc(doc)
+    # Validate the car and bump its booking counter in one round trip;
+    # matching on available also closes the race between concurrent bookings.
+    car = await db["car"].find_one_and_update(
+        {"_id": car_oid, "available": True},
+        {"$inc": {"bookings_count": 1}},
+        projection={"_id": 1},
+    )
+    if car is None:
+        raise HTTPException(status_code=404, detail="Car not found or unavailable")
+
+    now = datetime.now(timezone.utc)
+    data = msgspec.to_builtins(payload)
+    data["status"] = "pending"
+    data["payment_status"] = "unpaid"
+    data["created_at"] = now
+    data["updated_at"] = now
+    inserted = await db["booking"].insert_one(data)
+    _invalidate_cars_cache()  # booking may affect car availability
+    data["_id"] = inserted.inserted_id
+    return serialize_doc(data)
 
 
 @app.get("/api/bookings")
-def list_bookings(user_id: Optional[str] = None, limit: int = Query(50, ge=1, le=200)):
+async def list_bookings(user_id: Optional[str] = None, limit: int = Query(50, ge=1, le=200)):
     if db is None:
-        demo = [
-            {
-                "id": "demo-book-1",
-                "user_id": "u1",
-                "car_id": "demo-1",
-                "pickup_location": "Downtown",
-                "dropoff_location": "Airport",
-                "start_date": "2025-12-01",
-                "end_date": "2025-12-05",
-                "total_price": 356,
-                "status": "confirmed",
-                "payment_status": "paid",
-            }
-        ]
-        return {"items": demo[:limit], "count": len(demo[:limit])}
+        return Response(content=_DEMO_BOOKINGS_JSON, media_type="application/json")
 
     query: Dict[str, Any] = {}
     if user_id:
         query["user_id"] = user_id
-    cursor = db["booking"].find(query).sort("created_at", -1).limit(limit)
-    items = [serialize_doc(doc) for doc in cursor]
-    return {"items": items, "count": len(items)}
+    cursor = db["booking"].find_raw_batches(
+        query, sort=_BOOKINGS_SORT, limit=limit, batch_size=min(limit, 101)
+    )
+
+    # Stream batches out as they arrive instead of materializing the whole
+    # page: TCP recv of the next batch overlaps with encoding the current
+    # one, and peak memory stays at one batch rather than the full result.
+    async def _stream():
+        yield b'{"items":['
+        count = 0
+        async for raw_batch in cursor:
+            docs = decode_all(raw_batch)
+            if not docs:
+                continue
+            chunk = b",".join(orjson.dumps(doc) for doc in serialize_batch(docs))
+            yield b"," + chunk if count else chunk
+            count += len(docs)
+        yield b'],"count":%d}' % count
+
+    return StreamingResponse(_stream(), media_type="application/json")
 
 
 @app.post("/api/seed")
-def seed_demo_cars():
+async def seed_demo_cars():
     if db is None:
         return {"status": "no-db", "message": "Database not configured in this environment"}
-    if db["car"].count_documents({}) > 0:
+    if await db["car"].count_documents({}) > 0:
         return {"status": "ok", "message": "Cars already exist"}
 
     cars = [
@@ -313,12 +539,18 @@ def seed_demo_cars():
             "description": "Reliable and efficient daily driver.",
         },
     ]
-    db["car"].insert_many(cars)
+    # Client-side _ids skip the server id round trip, and ordered=False lets
+    # the server apply the batch without serializing on acknowledgments.
+    for car in cars:
+        car["_id"] = ObjectId()
+    await db["car"].insert_many(cars, ordered=False)
+    _invalidate_cars_cache()
+    _invalidate_collections_cache()
     return {"status": "ok", "inserted": len(cars)}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -335,7 +567,7 @@ def test_database():
             response["database_name"] = db.name
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await _cached_collection_names()
                 response["collections"] = collections[:10]
             except Exception as e:
                 response["database"] = f"⚠️ Connected but Error: {str(e)[:50]}"
@@ -345,8 +577,8 @@ def test_database():
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
     # Env flags
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = _DATABASE_URL_SET
+    response["database_name"] = _DATABASE_NAME_SET
     return response
 
 